@@ -1,45 +1,147 @@
 from tree_sitter import Language, Parser, Query, QueryCursor
 import tree_sitter_c as tsc
+from utils import models
 from utils.models import Captured_Struct, Captured_Enum, Captured_Function, Captured_Comment
 from utils.query_schema import query_schema
-from utils.vector_store import get_vector_store
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import version
+from itertools import chain
+import hashlib
+import inspect
 import os
+import pickle
+import re
+import sys
+
+# Comments with nothing worth searching for: empty or separator-only comments,
+# lint markers and the macro names written after #endif / #else
+TRIVIAL_COMMENT_RE = re.compile(
+    r"(?://|/\*)[\s*/=#-]*"
+    r"(?:(?:NOTREACHED|FALLTHROUGH|FALLTHRU|ARGSUSED|(?i:fall\s*through|not\s*reached)"
+    r"|!?\s*(?:defined\s*)?\(?[A-Z0-9]*_[A-Z0-9_]*\)?)[\s.:;]*)?"
+    r"[\s*/=#-]*"
+)
+
+# Captures of unchanged files are reused from this folder on the next run.
+# The query, the comment filter, the capture handlers of this module, the
+# pickled capture classes and the tree-sitter and grammar versions are part
+# of the key, so changing any of them invalidates the cache.
+AST_CACHE_DIR = ".ast_cache"
+AST_CACHE_VERSION = hashlib.md5("\0".join((
+    query_schema,
+    TRIVIAL_COMMENT_RE.pattern,
+    inspect.getsource(sys.modules[__name__]),
+    inspect.getsource(models),
+    version("tree-sitter"),
+    version("tree-sitter-c"),
+)).encode()).hexdigest()
 
 # Initialize the C language
 C_LANGUAGE = Language(tsc.language())
-# Create a parser
-parser = Parser(C_LANGUAGE)
-# Create a query and cursor
-query = Query(C_LANGUAGE, query_schema)
-cursor = QueryCursor(query)
+# Parser, query and cursor are not picklable, so every worker process
+# builds its own through _init_parser
+parser = None
+query = None
+cursor = None
 
-def parse_c_code(code: str):
+
+def _init_parser():
+    """
+    Creates the parser, query and cursor for the current process.
+    """
+    global parser, query, cursor
+    parser = Parser(C_LANGUAGE)
+    query = Query(C_LANGUAGE, query_schema)
+    cursor = QueryCursor(query)
+
+
+def parse_c_code(code: bytes):
     """
     The function parses C code and returns the corresponding AST.
     
     Args:
-        code: C source code as a string
+        code: C source code as bytes
     
     Returns:
         tree_sitter.Tree: The parsed syntax tree
     """
+    if parser is None:
+        _init_parser()
+
     # Parse the code
-    tree = parser.parse(bytes(code, "utf8"))
+    tree = parser.parse(code)
     return tree
 
 
-def read_c_code_from_file(file_path: str) -> str:
+def read_c_code_from_file(file_path: str) -> bytes:
     """
     Read C code from a file.
     
     Args:
         file_path: Path to the C source file
     Returns:
-        str: C source code as a string
+        bytes: C source code as bytes, ready to be passed to the parser
     """
-    with open(file_path, 'r') as file:
+    with open(file_path, 'rb') as file:
         return file.read()
 
+
+def _leading_comment(cap: dict, node):
+    """
+    Returns the text of the comment captured right before the definition, if any.
+    """
+    comment_nodes = cap.get("leading_comment")
+    if comment_nodes:
+        return comment_nodes[0].text.decode('utf8')
+    # The query's anchor doesn't match inside ERROR nodes (macro-heavy code
+    # that fails to parse), so check the node's previous sibling directly
+    prev_node = node.prev_sibling
+    if prev_node and prev_node.type == "comment":
+        return prev_node.text.decode('utf8')
+    return None
+
+
+def _capture_struct(cap: dict, file_path: str, captured_structs: list):
+    struct_node = cap["struct"][0]
+    if "struct_name" not in cap:
+        struct_name = "STRUCT_WITH_NO_NAME"
+    else:
+        struct_name = cap["struct_name"][0].text.decode('utf8')
+
+    struct_body = struct_node.text.decode('utf8')
+    captured_structs.append(Captured_Struct(struct_name, struct_body, file_path, _leading_comment(cap, struct_node)))
+
+
+def _capture_enum(cap: dict, file_path: str, captured_enums: list):
+    enum_node = cap["enum"][0]
+    if "enum_name" not in cap:
+        enum_name = "ENUM_WITH_NO_NAME"
+    else:
+        enum_name = cap["enum_name"][0].text.decode('utf8')
+
+    enum_body = enum_node.text.decode('utf8')
+    captured_enums.append(Captured_Enum(enum_name, enum_body, file_path, _leading_comment(cap, enum_node)))
+
+
+def _capture_function(cap: dict, file_path: str, captured_functions: list):
+    func_node = cap["func_body"][0]
+    func_name = cap["func_name"][0].text.decode('utf8')
+    func_body = func_node.text.decode('utf8')
+    # Captured_Function drops repeated call sites
+    called_funcs = [called_func.text.decode('utf8') for called_func in cap.get("called_func", ())]
+    captured_functions.append(Captured_Function(func_name, func_body, called_funcs, file_path, _leading_comment(cap, func_node)))
+
+
+def _capture_comments(cap: dict, file_path: str, comment_nodes: list):
+    # Comment text is decoded in one pass once all matches are collected
+    comment_nodes.extend(cap["comments"])
+
+
+# Capture handlers indexed by the pattern index in query_schema
+# (0: struct, 1: enum, 2: function, 3: comment)
+HANDLERS = (_capture_struct, _capture_enum, _capture_function, _capture_comments)
+
+
 def capture_objects_from_file(file_path: str) -> tuple:
     """
     Extract and capture objects from a C source file.
@@ -50,7 +152,6 @@ def capture_objects_from_file(file_path: str) -> tuple:
         list: Lists of captured functions, structs, enums, and comments
     """
 
-    # Example C code
     c_code = read_c_code_from_file(file_path)
 
     # Parse the code
@@ -65,74 +166,49 @@ def capture_objects_from_file(file_path: str) -> tuple:
     captured_functions = []
     captured_structs = []
     captured_enums = []
-    captured_comments = []
-
-    for capture in captures:
-        # Capture struct definitions
-        if capture[0] == 0:
-            # check for comment node before struct
-            curr_node = capture[1]["struct"][0]
-            prev_node = curr_node.prev_sibling
-            comment_text = None
-
-            if prev_node and prev_node.type == "comment":
-                comment_text = prev_node.text.decode('utf8')
-            
-            if "struct_name" not in capture[1].keys():
-                struct_name = "STRUCT_WITH_NO_NAME"
-            else:
-                struct_name = capture[1]["struct_name"][0].text.decode('utf8')
-            
-            struct_body = capture[1]["struct"][0].text.decode('utf8')
-            captured_struct = Captured_Struct(struct_name, struct_body, file_path, comment_text)
-            captured_structs.append(captured_struct)
-        # Capture enum definitions
-        elif capture[0] == 1:
-            # check for comment node before enum
-            curr_node = capture[1]["enum"][0]
-            prev_node = curr_node.prev_sibling
-            comment_text = None
-            if prev_node and prev_node.type == "comment":
-                comment_text = prev_node.text.decode('utf8')
-            
-            if "enum_name" not in capture[1].keys():
-                enum_name = "ENUM_WITH_NO_NAME"
-            else:
-                enum_name = capture[1]["enum_name"][0].text.decode('utf8')
-
-            enum_body = capture[1]["enum"][0].text.decode('utf8')
-            captured_enum = Captured_Enum(enum_name, enum_body, file_path, comment_text)
-            captured_enums.append(captured_enum)
-        # Capture function definitions
-        elif capture[0] == 2:
-            # check for comment node before function
-            curr_node = capture[1]["func_body"][0]
-            prev_node = curr_node.prev_sibling
-            comment_text = None
-            if prev_node and prev_node.type == "comment":
-                comment_text = prev_node.text.decode('utf8')
-
-            func_name = capture[1]["func_name"][0].text.decode('utf8')
-            func_body = capture[1]["func_body"][0].text.decode('utf8')
-            called_funcs = []
-            if "called_func" in capture[1].keys():
-                for called_func_capture in capture[1]["called_func"]:
-                    called_func_name = called_func_capture.text.decode('utf8')
-                    if called_func_name not in called_funcs:
-                        called_funcs.append(called_func_name)
-            captured_function = Captured_Function(func_name, func_body, called_funcs, file_path, comment_text)
-            captured_functions.append(captured_function)
-        # Capture comments
-        elif capture[0] == 3:
-            comments = capture[1]["comments"]
-            for comment in comments:
-                comment_text = comment.text.decode('utf8')
-                captured_comment = Captured_Comment(comment_text, file_path)
-                captured_comments.append(captured_comment)
+    comment_nodes = []
+    # Output list for each pattern index, in the same order as HANDLERS
+    out_lists = (captured_structs, captured_enums, captured_functions, comment_nodes)
+
+    for pattern_index, cap in captures:
+        HANDLERS[pattern_index](cap, file_path, out_lists[pattern_index])
+
+    comment_texts = [node.text.decode('utf8') for node in comment_nodes]
+    # Skip boilerplate comments so they are never embedded
+    captured_comments = [
+        Captured_Comment(comment_text, file_path)
+        for comment_text in comment_texts
+        if not TRIVIAL_COMMENT_RE.fullmatch(comment_text)
+    ]
 
     return captured_functions, captured_structs, captured_enums, captured_comments
 
 
+def capture_objects_from_file_cached(file_path: str) -> tuple:
+    """
+    Same as capture_objects_from_file, but reuses the captures pickled by an
+    earlier run if the file's modification time and size are unchanged.
+    """
+    stat = os.stat(file_path)
+    key = (AST_CACHE_VERSION, file_path, stat.st_mtime_ns, stat.st_size)
+    cache_path = os.path.join(AST_CACHE_DIR, hashlib.md5(file_path.encode()).hexdigest() + ".pkl")
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cached_key, captured = pickle.load(f)
+        if cached_key == key:
+            return captured
+
+    captured = capture_objects_from_file(file_path)
+
+    # Write to a temporary file first so a crash never leaves a truncated entry
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((key, captured), f)
+    os.replace(tmp_path, cache_path)
+    return captured
+
+
 def main():
     # Store the list of files inside a specified folder name
     folder_path = './coreutils/src'
@@ -143,17 +219,19 @@ def main():
             if file.endswith('.c') or file.endswith('.h'):
                 file_names.append(root+'/'+file)
             
-    list_of_captured_functions = []
-    list_of_captured_structs = []
-    list_of_captured_enums = []
-    list_of_captured_comments = []
-
-    for file_name in file_names:
-        captured_functions, captured_structs, captured_enums, captured_comments = capture_objects_from_file(file_name)
-        list_of_captured_functions.extend(captured_functions)
-        list_of_captured_structs.extend(captured_structs)
-        list_of_captured_enums.extend(captured_enums)
-        list_of_captured_comments.extend(captured_comments)
+    # Files are independent, so parse them on all cores
+    os.makedirs(AST_CACHE_DIR, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_parser) as pool:
+        results = list(pool.map(capture_objects_from_file_cached, file_names, chunksize=8))
+
+    # Imported once the workers are gone, so none of them loads (or, forked,
+    # inherits) the embedding model
+    from utils.vector_store import get_vector_store
+
+    list_of_captured_functions = list(chain.from_iterable(result[0] for result in results))
+    list_of_captured_structs = list(chain.from_iterable(result[1] for result in results))
+    list_of_captured_enums = list(chain.from_iterable(result[2] for result in results))
+    list_of_captured_comments = list(chain.from_iterable(result[3] for result in results))
 
     print("\n\n" + str(len(list_of_captured_functions)) + " functions captured.")
     print(str(len(list_of_captured_structs)) + " structs captured.")
@@ -1,7 +1,9 @@
 from typing import Annotated, TypedDict, List
 import os
+import logging
 import textwrap
 import re
+from uuid import uuid4
 from langchain_groq import ChatGroq
 from langchain_core.messages import SystemMessage, HumanMessage, AnyMessage, trim_messages, AIMessage, ToolMessage
 from langchain_core.messages.utils import count_tokens_approximately
@@ -11,10 +13,27 @@ from langgraph.prebuilt import ToolNode
 from langgraph.checkpoint.memory import InMemorySaver
 import streamlit as st
 from dotenv import load_dotenv
-from utils.tools import search_concepts, search_implementations
+from utils.tools import search_concepts, search_implementations, reload_vector_stores
 
 load_dotenv()
 
+# Groq model used by the agent. Set GROQ_MODEL to trade answer quality for
+# latency, e.g. a smaller instant model.
+GROQ_MODEL = os.environ.get("GROQ_MODEL", "openai/gpt-oss-20b")
+# Upper bound on generated tokens per LLM call (reasoning included), so a
+# runaway completion can't stall a turn
+GROQ_MAX_TOKENS = int(os.environ.get("GROQ_MAX_TOKENS", "4096"))
+# gpt-oss spends most of its output on hidden reasoning. "low" keeps that
+# short for retrieval-grounded answers. Other models get no reasoning effort
+# by default, models without reasoning reject the parameter.
+GROQ_REASONING_EFFORT = os.environ.get(
+    "GROQ_REASONING_EFFORT", "low" if GROQ_MODEL.startswith("openai/gpt-oss-") else ""
+)
+
+# Node tracing is logged at DEBUG, set LOG_LEVEL=DEBUG to see it
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper())
+log = logging.getLogger(__name__)
+
 # Initialize Streamlit
 st.set_page_config(page_title="GNU Coreutils AI Navigator", page_icon="🐧")
 st.markdown("""
@@ -38,7 +57,7 @@ if "messages" not in st.session_state:
     st.session_state["messages"] = [{"role": "assistant", "content": "Let's start chatting! 👇"}]
 
 if "thread_id" not in st.session_state:
-    st.session_state["thread_id"] = str(os.urandom(8).hex())
+    st.session_state["thread_id"] = uuid4().hex[:16]
 
 # ==============================================================================
 # DEFINE LANGGRAPH STATE
@@ -50,6 +69,111 @@ class AgentState(TypedDict):
     terminate: bool
     terminate_message: str
 
+# ==============================================================================
+# TOKEN COUNTING
+# ==============================================================================
+
+# Approximate token count of every message seen so far, keyed by message id.
+# add_messages gives each state message a stable id, so a message is counted
+# once instead of on every trim of every later turn.
+_token_count_cache = {}
+_TOKEN_COUNT_CACHE_SIZE = 10_000
+
+def cached_token_counter(messages: List[AnyMessage]) -> int:
+    """
+    Drop-in replacement for count_tokens_approximately that caches the count
+    of each message. trim_messages calls its counter on many sub-lists of the
+    history, so only messages without a cached count are actually counted.
+    """
+    total = 0
+    for m in messages:
+        if m.id is None:
+            total += count_tokens_approximately([m])
+            continue
+
+        count = _token_count_cache.get(m.id)
+        if count is None:
+            if len(_token_count_cache) >= _TOKEN_COUNT_CACHE_SIZE:
+                _token_count_cache.clear()
+            count = count_tokens_approximately([m])
+            _token_count_cache[m.id] = count
+        total += count
+    return total
+
+# ==============================================================================
+# PROMPTS & TRIM SETTINGS
+# ==============================================================================
+
+# Built once at import, every step of every turn reuses the same objects
+SYSTEM_PROMPT_TEXT = textwrap.dedent("""
+    You are an expert C/C++ technical assistant analyzing the GNU Coreutils library **ONLY**.
+    To understand high-level behavior, search for documentation and developer comments, use 'search_concepts'.
+    To search for C code, structs, enums or function use 'search_implementations'.
+    If the user asks about ANY topic unrelated to Coreutils, C programming, or Linux system calls, you must:
+    1. REFUSE to answer.
+    2. State clearly: 'I can only assist with GNU Coreutils and related system programming topics.'
+    3. DO NOT try to be helpful or provide a 'brief' answer to the off-topic query.
+    If you are **UNSURE** or **UNABLE TO ANSWER**, output the final answer **immediately** or specify 'I cannot help you with this query'.
+    The user may ask wrong or misleading questions. Always provide the correct information.
+    Do not double-check your work. Be decisive.
+    Keep your responses concise and to the point and make sure the response is human understandable.
+    Always cite the file name when explaining logic.
+""").strip()
+
+# System prompt to ground the agent's behavior
+SYSTEM_MSG = SystemMessage(content=SYSTEM_PROMPT_TEXT)
+
+# System message that effectively says "Time's up!" to the finalizer
+FORCE_MSG = SystemMessage(content=(
+    "SYSTEM NOTICE: You have reached the maximum number of reasoning steps. "
+    "Stop using tools immediately. "
+    "Summarize the information you have gathered so far to answer the user's question. "
+    "If you don't have the full answer, explain what you found and what is missing."
+))
+
+TRIM_KWARGS = {
+    "strategy": "last",
+    "token_counter": cached_token_counter,
+    "max_tokens": 10000,
+    "start_on": "human",
+    "end_on": ("human", "tool"),
+}
+
+# The finalizer bounds its prompt like agent_node does (the thread history
+# grows every turn), but its history is sanitized so there is no tool end
+FINALIZER_TRIM_KWARGS = {k: v for k, v in TRIM_KWARGS.items() if k != "end_on"}
+
+# count_tokens_approximately counts about 4 characters per token, so a history
+# with less than this (see _history_chars) is well inside max_tokens and
+# trimming it would return it unchanged
+TRIM_SKIP_CHARS = 30_000
+# Counted for every message on top of its content: the role, the 3 extra
+# tokens per message and the rounding up to whole tokens
+_MESSAGE_OVERHEAD_CHARS = 32
+
+def _history_chars(messages: List[AnyMessage]) -> int:
+    """
+    Upper bound on the characters count_tokens_approximately counts for the
+    messages, tool call arguments and list (content block) content included.
+    """
+    total = 0
+    for m in messages:
+        total += _MESSAGE_OVERHEAD_CHARS
+        total += len(m.content) if isinstance(m.content, str) else len(repr(m.content))
+        if isinstance(m, AIMessage) and m.tool_calls:
+            total += len(repr(m.tool_calls))
+        if isinstance(m, ToolMessage):
+            total += len(m.tool_call_id)
+    return total
+
+def trim_history(messages: List[AnyMessage], trim_kwargs: dict) -> List[AnyMessage]:
+    """
+    trim_messages, skipped for the short histories of the first turns.
+    """
+    if _history_chars(messages) < TRIM_SKIP_CHARS:
+        return messages
+    return trim_messages(messages, **trim_kwargs)
+
 # ==============================================================================
 # INITIALIZE MODEL & NODES
 # ==============================================================================
@@ -60,22 +184,11 @@ def navigation_router(state: AgentState):
     If the last message contains tool_calls, we go to the tools node.
     Otherwise, we end the workflow.
     """
-    print("Inside Navigation Router")
-    if state.get("terminate", False):
+    if state.get("terminate"):
         return END
-
-    current_step = state.get("loop_step", 0)
-    print("Current Step:", current_step)
-    if current_step >= 5:
+    if state.get("loop_step", 0) >= 5:
         return "finalizer"
-    
-    last_message = state["messages"][-1]
-    if last_message.tool_calls:
-        print("Routing to tools...")
-        return "tools"
-    
-    print("Routing to end...")
-    return END
+    return "tools" if state["messages"][-1].tool_calls else END
 
 def sanitize(messages):
     """
@@ -84,15 +197,34 @@ def sanitize(messages):
     :param messages: List[AnyMessage]
     :return: List[AnyMessage]
     """
-    cleaned = []
-    for m in messages:
-        if isinstance(m, ToolMessage):
-            continue
-        if isinstance(m, AIMessage):
-            cleaned.append(AIMessage(content=m.content))
-        else:
-            cleaned.append(m)
-    return cleaned
+    # Only AI messages that carry tool calls are rebuilt, everything else is
+    # passed through as is (which also keeps its id for the token count cache)
+    return [
+        AIMessage(content=m.content)
+        if isinstance(m, AIMessage) and (m.tool_calls or m.invalid_tool_calls)
+        else m
+        for m in messages
+        if not isinstance(m, ToolMessage)
+    ]
+
+_RATE_LIMIT_RE = re.compile(r"Please try again in (.*?)\.")
+
+def _format_llm_error(e: Exception) -> str:
+    """
+    Builds the user-facing message for a failed LLM call. Rate limit errors
+    (HTTP 429) get the wait time from the provider's message when it gives
+    one, any other error is reported as is.
+    """
+    error_message = getattr(e, "message", str(e))
+    if getattr(e, "status_code", None) != 429:
+        log.warning("LLM call failed: %s", error_message)
+        return f"⚠️ The request to the language model failed: {error_message}"
+
+    match = _RATE_LIMIT_RE.search(error_message)
+    if match:
+        wait_time = match.group(1)
+        return f"⚠️ System is currently busy. Please wait {wait_time} before trying again."
+    return "⚠️ Rate limit reached. Please try again in a few minutes."
 
 
 # ==============================================================================
@@ -109,9 +241,11 @@ def initialize_graph():
     # List of tools for the Agent
     tools = [search_concepts, search_implementations]
     # Initialize LLM and bind tools
-    llm = ChatGroq(model="openai/gpt-oss-20b", temperature=0.3)
+    llm = ChatGroq(model=GROQ_MODEL,
+                   temperature=0.3,
+                   max_tokens=GROQ_MAX_TOKENS,
+                   reasoning_effort=GROQ_REASONING_EFFORT or None)
     llm_with_tools = llm.bind_tools(tools)
-    final_llm = llm.bind_tools([], tool_choice="none")
 
 
     def agent_node(state: AgentState):
@@ -119,34 +253,9 @@ def initialize_graph():
         The main reasoning node.
         It receives the history and decides whether to answer or call a tool.
         """
-        print("Inside Agent Node")
-
-        system_msg = textwrap.dedent("""
-            You are an expert C/C++ technical assistant analyzing the GNU Coreutils library **ONLY**.
-            To understand high-level behavior, search for documentation and developer comments, use 'search_concepts'.
-            To search for C code, structs, enums or function use 'search_implementations'.
-            If the user asks about ANY topic unrelated to Coreutils, C programming, or Linux system calls, you must:
-            1. REFUSE to answer.
-            2. State clearly: 'I can only assist with GNU Coreutils and related system programming topics.'
-            3. DO NOT try to be helpful or provide a 'brief' answer to the off-topic query.
-            If you are **UNSURE** or **UNABLE TO ANSWER**, output the final answer **immediately** or specify 'I cannot help you with this query'.
-            The user may ask wrong or misleading questions. Always provide the correct information.
-            Do not double-check your work. Be decisive.
-            Keep your responses concise and to the point and make sure the response is human understandable.
-            Always cite the file name when explaining logic.
-        """).strip()
-
-        # System prompt to ground the agent's behavior
-        system_msg = SystemMessage(content=system_msg)
-
-        trimmed_messages = trim_messages(state["messages"],
-                                        strategy="last",
-                                        token_counter=count_tokens_approximately,
-                                        max_tokens=10000,
-                                        start_on="human",
-                                        end_on=("human", "tool"),)
-
-        messages = [system_msg] + trimmed_messages
+        log.debug("Inside Agent Node")
+
+        messages = [SYSTEM_MSG] + trim_history(state["messages"], TRIM_KWARGS)
 
         try:
             response = llm_with_tools.invoke(messages)
@@ -155,15 +264,7 @@ def initialize_graph():
                 current_step = state.get("loop_step", 0)
             return {"messages": [response], "loop_step": current_step + 1, "terminate": False, "terminate_message": ""}
         except Exception as e:
-            error_message = e.message
-            match = re.search(r"Please try again in (.*?)\.", error_message)
-            message = ""
-            if match:
-                wait_time = match.group(1)
-                message = f"⚠️ System is currently busy. Please wait {wait_time} before trying again."
-            else:
-                message = "⚠️ Rate limit reached. Please try again in a few minutes."
-            return {"messages": [], "loop_step": 0, "terminate": True, "terminate_message": message}
+            return {"messages": [], "loop_step": 0, "terminate": True, "terminate_message": _format_llm_error(e)}
         
 
     def finalizer_node(state: AgentState):
@@ -171,34 +272,19 @@ def initialize_graph():
         Forces the agent to generate a final answer using currently available info.
         """
 
-        print("Inside Finalizer Node")
+        log.debug("Inside Finalizer Node")
 
         # Sanitize messages to remove tool call metadata
         sanitized_messages = sanitize(state["messages"])
 
-        # Create a system message that effectively says "Time's up!"
-        force_msg = SystemMessage(content=(
-            "SYSTEM NOTICE: You have reached the maximum number of reasoning steps. "
-            "Stop using tools immediately. "
-            "Summarize the information you have gathered so far to answer the user's question. "
-            "If you don't have the full answer, explain what you found and what is missing."
-        ))
-        
-        messages = sanitized_messages + [force_msg]
+        messages = trim_history(sanitized_messages, FINALIZER_TRIM_KWARGS) + [FORCE_MSG]
 
         try:
-            response = final_llm.invoke(messages)
+            # The plain model has no tools bound, so it can only answer
+            response = llm.invoke(messages)
             return {"messages": [response], "loop_step": 0, "terminate": False, "terminate_message": ""}
         except Exception as e:
-            error_message = e.message
-            match = re.search(r"Please try again in (.*?)\.", error_message)
-            message = ""
-            if match:
-                wait_time = match.group(1)
-                message = f"⚠️ System is currently busy. Please wait {wait_time} before trying again."
-            else:
-                message = "⚠️ Rate limit reached. Please try again in a few minutes."
-            return {"messages": [], "loop_step": 0, "terminate": True, "terminate_message": message}
+            return {"messages": [], "loop_step": 0, "terminate": True, "terminate_message": _format_llm_error(e)}
 
     tool_node = ToolNode(tools,)
 
@@ -235,6 +321,11 @@ def initialize_graph():
 app = initialize_graph()
 
 
+# After rebuilding the indexes, loads them without restarting the app
+with st.sidebar:
+    if st.button("Reload indices", help="Load the vector stores again from disk"):
+        reload_vector_stores()
+
 # Display existing chat history
 for msg in st.session_state.messages:
     if msg["role"] == "user":
@@ -257,17 +348,36 @@ if prompt := st.chat_input("How can I assist you?..."):
             input_message = HumanMessage(content=prompt)
             config = {"configurable": {"thread_id": st.session_state.thread_id}}
             final_response = ""
-            
-            for event in app.stream({"messages": [input_message]}, config=config):
+            # Answer text streamed so far, reset for every new LLM message
+            partial, partial_id = "", None
+
+            for mode, event in app.stream({"messages": [input_message]}, config=config,
+                                          stream_mode=["updates", "messages"]):
+                # Tokens as the LLM generates them, so the answer shows up
+                # before the node returns
+                if mode == "messages":
+                    chunk, metadata = event
+                    if metadata.get("langgraph_node") not in ("agent", "finalizer"):
+                        continue
+                    if chunk.id != partial_id:
+                        partial, partial_id = "", chunk.id
+                    if chunk.content and not chunk.tool_call_chunks:
+                        partial += chunk.content
+                        message_placeholder.markdown(partial + "▌")
+                    continue
+
                 # CASE A: The Agent Just Spoke (Thinking or Tool Call)
                 if "agent" in event:
                     if event["agent"].get("terminate", False):
                         final_response = event["agent"].get("terminate_message", "⚠️ The agent has terminated the conversation.")
                         break
                     msg = event["agent"]["messages"][0]
-                    if msg.tool_calls:
-                        tool_name = msg.tool_calls[0]['name']
-                        tool_args = msg.tool_calls[0]['args']
+                    tool_calls = msg.tool_calls
+                    if tool_calls:
+                        # Not the answer, drop any text streamed with the tool call
+                        message_placeholder.empty()
+                        tool_name = tool_calls[0]['name']
+                        tool_args = tool_calls[0]['args']
                         status.update(label=f"Executing {tool_name}...", state="running")
                     else:
                         # If no tool call, this is the final answer
@@ -290,8 +400,8 @@ if prompt := st.chat_input("How can I assist you?..."):
             # 3. Final Polish
             status.update(label="Your response is ready!", state="complete", expanded=True)
 
-            # Display Final Answer
-            st.markdown(final_response)
+            # Display Final Answer in place of the streamed text
+            message_placeholder.markdown(final_response)
 
             # Add to history
             st.session_state.messages.append({"role": "assistant", "content": final_response})
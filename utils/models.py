@@ -1,4 +1,7 @@
 class Captured_Comment:
+    # Comments are by far the most numerous captures, slots keep them small
+    __slots__ = ("comment_text", "file_name")
+
     def __init__(self, text: str, file_name: str) -> None:
         self.comment_text = text
         self.file_name = file_name
@@ -16,10 +19,13 @@ class Captured_Comment:
         }
 
 class Captured_Function:
+    __slots__ = ("function_name", "function_body", "called_functions", "comment", "file_name")
+
     def __init__(self, name: str, body: str, called_functions: list, file_name: str, comment: str = None) -> None:
         self.function_name = name
         self.function_body = body
-        self.called_functions = called_functions
+        # Every call site is captured, keep each callee once in call order
+        self.called_functions = tuple(dict.fromkeys(called_functions))
         self.comment = comment
         self.file_name = file_name
 
@@ -32,13 +38,15 @@ class Captured_Function:
     def get_metadata(self):
         return {
             "function_name": self.function_name,
-            "called_functions": self.called_functions,
+            "called_functions": list(self.called_functions),
             "document_type": "function_definition",
             "function_comment": self.comment,
             "file_name": self.file_name
         }
 
 class Captured_Struct:
+    __slots__ = ("struct_name", "struct_body", "comment", "file_name")
+
     def __init__(self, name: str, body: str, file_name: str, comment: str = None) -> None:
         self.struct_name = name
         self.struct_body = body
@@ -60,6 +68,8 @@ class Captured_Struct:
         }
 
 class Captured_Enum:
+    __slots__ = ("enum_name", "enum_body", "comment", "file_name")
+
     def __init__(self, name: str, body: str, file_name: str, comment: str = None) -> None:
         self.enum_name = name
         self.enum_body = body
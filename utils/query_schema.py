@@ -1,32 +1,45 @@
-
 # For now:
 # Ignoring the typedef and storage class specifiers for structs and enums
 # For functions I have considered pointer return and normal return types
+# The optional @leading_comment captures the comment placed right before a
+# struct, enum or function (the "." anchor makes them immediate siblings)
 
 query_schema = """
-    (struct_specifier
-        name: (type_identifier)? @struct_name
-        body: (field_declaration_list)
-    ) @struct
-    (enum_specifier
-        name: (type_identifier)? @enum_name
-        body: (enumerator_list)
-    ) @enum
-    (function_definition
-        declarator: [
-            (function_declarator
-            declarator: (identifier) @func_name)
-            (pointer_declarator
-            declarator: (function_declarator
-                declarator: (identifier) @func_name))
-        ]
-        body: (compound_statement
-            (expression_statement
-                (call_expression
-                    function: (identifier) @called_func
-                )
-            )*
-        )
-    ) @func_body
+    (
+        (comment)? @leading_comment
+        .
+        (struct_specifier
+            name: (type_identifier)? @struct_name
+            body: (field_declaration_list)
+        ) @struct
+    )
+    (
+        (comment)? @leading_comment
+        .
+        (enum_specifier
+            name: (type_identifier)? @enum_name
+            body: (enumerator_list)
+        ) @enum
+    )
+    (
+        (comment)? @leading_comment
+        .
+        (function_definition
+            declarator: [
+                (function_declarator
+                declarator: (identifier) @func_name)
+                (pointer_declarator
+                declarator: (function_declarator
+                    declarator: (identifier) @func_name))
+            ]
+            body: (compound_statement
+                (expression_statement
+                    (call_expression
+                        function: (identifier) @called_func
+                    )
+                )*
+            )
+        ) @func_body
+    )
     (comment) @comments
-    """
\ No newline at end of file
+    """
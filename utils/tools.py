@@ -1,37 +1,111 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import faiss
 from langchain_core.tools import tool
 import streamlit as st
-from utils.vector_store import get_vector_store
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from utils.vector_store import embeddings, get_vector_store
 
+log = logging.getLogger(__name__)
 
-@st.cache_resource
-def load_vector_stores():
-    """Load and return all vector stores."""
 
-    f_stores = get_vector_store(
+# FAISS runs on an OpenMP thread per core by default. In the app several
+# searches run at once, next to the embedding model and Streamlit, so they
+# share half the cores instead of oversubscribing all of them. Index builds
+# don't import this module and keep every core. OMP_NUM_THREADS overrides it.
+if "OMP_NUM_THREADS" not in os.environ:
+    faiss.omp_set_num_threads(max(1, (os.cpu_count() or 1) // 2))
+
+# One cached loader per store: each index is loaded once and shared across
+# sessions, and no session gets a mutable dict holding all of them. They are
+# reloaded once a day, so a rebuilt index is picked up without a restart (see
+# also reload_vector_stores).
+
+@st.cache_resource(ttl="24h", max_entries=1)
+def _function_store():
+    return get_vector_store(
         index_name="vector_db_index/coreutils_index_functions_structs_enums",
         load_from_disk=True
     )
 
-    c_stores = get_vector_store(
+@st.cache_resource(ttl="24h", max_entries=1)
+def _comment_store():
+    return get_vector_store(
         index_name="vector_db_index/coreutils_index_comments",
         load_from_disk=True
     )
 
-    r_stores = get_vector_store(
+@st.cache_resource(ttl="24h", max_entries=1)
+def _readme_store():
+    return get_vector_store(
         index_name="vector_db_index/coreutils_index_readmes",
         load_from_disk=True
     )
 
-    return {
-        "function_store": f_stores,
-        "comment_store": c_stores,
-        "readme_store": r_stores
-    }
+def _warm_vector_stores():
+    """
+    Loads the three stores concurrently at startup, so the first searches
+    find them in the cache. The workers get the script's context to show the
+    loading spinners.
+    """
+    ctx = get_script_run_ctx()
+
+    def load(loader):
+        add_script_run_ctx(ctx=ctx)
+        return loader()
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(load, (_function_store, _comment_store, _readme_store)))
+
+_warm_vector_stores()
+
+# --- 1. Query cache ---
+# The agent often repeats a search across steps, turns and sessions. Hits are
+# cached per store on the normalized query, the embedding model is uncased so
+# lowercasing and collapsing whitespace doesn't change them. They are kept as
+# (page_content, metadata) pairs, which cache_data can pickle.
+
+# Reused across calls for the two concept searches, which are independent
+_search_pool = ThreadPoolExecutor(max_workers=2)
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+# The query is embedded once and the vector shared by every store it is
+# searched in, the stores were all built with the same embedding model
+@st.cache_data(ttl="1h", max_entries=512, show_spinner=False)
+def _embed_query(query: str) -> list:
+    return embeddings.embed_query(query)
 
-stores = load_vector_stores()
-function_store = stores["function_store"]
-comment_store = stores["comment_store"]
-readme_store = stores["readme_store"]
+def _hits(docs) -> tuple:
+    return tuple((doc.page_content, doc.metadata) for doc in docs)
+
+@st.cache_data(ttl="1h", max_entries=512, show_spinner=False)
+def _search_readmes(query: str, k: int) -> tuple:
+    return _hits(_readme_store().similarity_search_by_vector(_embed_query(query), k=k))
+
+@st.cache_data(ttl="1h", max_entries=512, show_spinner=False)
+def _search_comments(query: str, k: int) -> tuple:
+    return _hits(_comment_store().similarity_search_by_vector(_embed_query(query), k=k))
+
+@st.cache_data(ttl="1h", max_entries=512, show_spinner=False)
+def _search_functions(query: str, k: int) -> tuple:
+    return _hits(_function_store().similarity_search_by_vector(_embed_query(query), k=k))
+
+def reload_vector_stores():
+    """
+    Drops the loaded stores and their cached hits, the stores are loaded again
+    from disk by the next search. Query embeddings stay valid and are kept.
+    """
+    for cached in (_function_store, _comment_store, _readme_store,
+                   _search_readmes, _search_comments, _search_functions):
+        cached.clear()
+
+def _format_hits(header: str, entries) -> str:
+    """Tool output: the header, a blank line, then one entry per line."""
+    return header + "\n\n" + "\n".join(entries)
 
 # --- 2. Tool A: The "Concept" Search (Readme + Comments) ---
 
@@ -42,37 +116,61 @@ def search_concepts(query: str) -> str:
     Searches high-level documentation (READMEs) and developer comments.
     Use this to find explanations, behavior summaries, or design notes.
     """
-    print(f"   [Concept Tool] Searching for: '{query}'...")
+    log.debug("[Concept Tool] Searching for: %r", query)
     
     # Retrieve top matches from both sources
-    readmes = readme_store.similarity_search(query, k=2)
-    comments = comment_store.similarity_search(query, k=5)
+    query_key = _normalize_query(query)
+    readmes = _search_pool.submit(_search_readmes, query_key, 2)
+    comments = _search_pool.submit(_search_comments, query_key, 5)
+    readmes, comments = readmes.result(), comments.result()
     
-    results = []
-    results.append(f"### CONCEPTUAL SEARCH RESULTS FOR: '{query}' ###\n")
-
-    # Format README results
-    if readmes:
-        results.append("--- SOURCE: PROJECT DOCUMENTATION (READMEs) ---")
-        for doc in readmes:
-            source = doc.metadata.get("file_name", "unknown_file")
-            results.append(f"[{source}]: {doc.page_content}\n")
-
-    # Format Comment results
-    if comments:
-        results.append("--- SOURCE: DEVELOPER COMMENTS ---")
-        for doc in comments:
-            source = doc.metadata.get("file", "unknown_file")
-            results.append(f"[{source}]: {doc.page_content}\n")
-            
     if not readmes and not comments:
         return "No relevant documentation or comments found."
 
-    return "\n".join(results)
+    return _format_hits(f"### CONCEPTUAL SEARCH RESULTS FOR: '{query}' ###", chain(
+        # README results
+        ("--- SOURCE: PROJECT DOCUMENTATION (READMEs) ---",) if readmes else (),
+        (f"[{meta.get('file_name', 'unknown_file')}]: {content}\n" for content, meta in readmes),
+        # Comment results
+        ("--- SOURCE: DEVELOPER COMMENTS ---",) if comments else (),
+        (f"[{meta.get('file', 'unknown_file')}]: {content}\n" for content, meta in comments),
+    ))
 
 
 # --- 3. Tool B: The "Implementation" Search (Functions + Call Graph) ---
 
+# Metadata keys holding the symbol name and its leading comment, per document type
+_SYMBOL_KEYS = {
+    "function_definition": ("function_name", "function_comment"),
+    "struct_definition": ("struct_name", "struct_comment"),
+    "enum_definition": ("enum_name", "enum_comment"),
+}
+
+def _format_symbol(content: str, meta: dict) -> str:
+    """Formats one function, struct or enum hit of search_implementations."""
+    type_ = meta.get("document_type", "unknown_file")
+    name_key, comment_key = _SYMBOL_KEYS.get(type_, _SYMBOL_KEYS["function_definition"])
+    name = meta.get(name_key, "unknown_symbol")
+    file = meta.get("file_name", "unknown_file")
+    function_comment = meta.get(comment_key, "No comment available.")
+
+    # --- KEY FEATURE: EXPOSING YOUR CALL LIST METADATA ---
+    # Since you stored 'calls' in metadata, we format it here for the Agent.
+    # This allows the Agent to see "Relationships" without a graph database.
+    # Captured_Function stores it as a list of names
+    calls_list = meta.get("called_functions", [])
+    calls_str = ", ".join(calls_list) if calls_list else "None"
+
+    return (
+        f"Type: {type_}\n"
+        f"Name: {name}\n"
+        f"File: {file}\n"
+        f"Calls functions: {calls_str}\n" # <--- The Agent sees the graph here
+        f"Comment: {function_comment}\n"
+        f"Code:\n{content}\n"
+        f"{'-'*40}\n"
+    )
+
 @tool
 def search_implementations(query: str) -> str:
     """
@@ -82,46 +180,17 @@ def search_implementations(query: str) -> str:
     Type: function_definition/struct_definition/enum_definition
     Name: <name>
     File: <file_name>
-    Calls functions: [<called_function_1>, <called_function_2>, ...]
+    Calls functions: <called_function_1>, <called_function_2>, ...
     Comment: <developer_comment>
     Code: <code_body>
     """
-    print(f"   [Code Tool] Searching for: '{query}'...")
+    log.debug("[Code Tool] Searching for: %r", query)
     
     # Retrieve top matches from function store
-    functions = function_store.similarity_search(query, k=3)
+    functions = _search_functions(_normalize_query(query), 3)
     
-    results = []
-    results.append(f"### CODE IMPLEMENTATION RESULTS FOR: '{query}' ###\n")
-
     if not functions:
         return "No matching functions or structs found."
 
-    for doc in functions:
-        meta = doc.metadata
-        name = meta.get("function_name", "unknown_symbol")
-        file = meta.get("file_name", "unknown_file")
-        type_ = meta.get("document_type", "unknown_file")
-        function_comment = meta.get("function_comment", "No comment available.")
-
-        # --- KEY FEATURE: EXPOSING YOUR CALL LIST METADATA ---
-        # Since you stored 'calls' in metadata, we format it here for the Agent.
-        # This allows the Agent to see "Relationships" without a graph database.
-        calls_list = meta.get("called_functions", []) # Expecting a list of strings
-        if isinstance(calls_list, str):    # Handle if stored as string representation
-             calls_list = calls_list.replace("[", "").replace("]", "").replace("'", "")
-        
-        calls_str = str(calls_list) if calls_list else "None"
-
-        entry = (
-            f"Type: {type_}\n"
-            f"Name: {name}\n"
-            f"File: {file}\n"
-            f"Calls functions: {calls_str}\n" # <--- The Agent sees the graph here
-            f"Comment: {function_comment}\n"
-            f"Code:\n{doc.page_content}\n"
-            f"{'-'*40}\n"
-        )
-        results.append(entry)
-
-    return "\n".join(results)
\ No newline at end of file
+    return _format_hits(f"### CODE IMPLEMENTATION RESULTS FOR: '{query}' ###",
+                        (_format_symbol(content, meta) for content, meta in functions))
\ No newline at end of file
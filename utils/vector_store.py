@@ -1,6 +1,17 @@
 import os
+import math
+import hashlib
+import json
+import pickle
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from typing import List
+import faiss
+import numpy as np
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
@@ -8,26 +19,356 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
 
 # --- Step 2: Initialize Embeddings ---
 # We use the open-source 'all-MiniLM-L6-v2' model via Hugging Face
-embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Inference backend of the model: "torch" or "onnx". ONNX Runtime is usually
+# 2-3x faster on CPU-only hosts and needs `sentence-transformers[onnx]`.
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+# ONNX file of the model repo to run with the onnx backend instead of the plain
+# export, e.g. "model_qint8_avx512_vnni.onnx" (int8, also avx2/avx512/arm64
+# variants) or "model_O3.onnx" (graph-optimized fp32)
+EMBEDDING_ONNX_FILE = os.environ.get("EMBEDDING_ONNX_FILE", "") if EMBEDDING_BACKEND == "onnx" else ""
 
-def get_vector_store(captured_items: list = [], index_name: str  = None, load_from_disk: bool = False) -> FAISS:
+
+def _cuda_available() -> bool:
+    if EMBEDDING_BACKEND != "torch":
+        return False
+    import torch
+    return torch.cuda.is_available()
+
+# On a CUDA GPU the torch backend runs in fp16, which halves the memory
+# traffic and runs on the tensor cores
+EMBEDDING_FP16 = _cuda_available()
+
+# Identifies the configuration the vectors come from. Quantized and half
+# precision models give slightly different vectors, so they count as
+# different models for the embedding cache and the saved stores.
+EMBEDDING_MODEL_ID = f"{EMBEDDING_MODEL_NAME}:{EMBEDDING_BACKEND}"
+if EMBEDDING_ONNX_FILE:
+    EMBEDDING_MODEL_ID += f":{EMBEDDING_ONNX_FILE}"
+if EMBEDDING_FP16:
+    EMBEDDING_MODEL_ID += ":fp16"
+
+
+def _load_embeddings() -> HuggingFaceEmbeddings:
+    """
+    Creates the embedding model for the configured backend and device.
+    """
+    model_kwargs = {"backend": EMBEDDING_BACKEND}
+    if EMBEDDING_FP16:
+        import torch
+        model_kwargs["device"] = "cuda"
+        model_kwargs["model_kwargs"] = {"torch_dtype": torch.float16}
+    elif EMBEDDING_ONNX_FILE:
+        model_kwargs["model_kwargs"] = {"file_name": EMBEDDING_ONNX_FILE}
+
+    # A large encode batch keeps the matmuls busy when embedding a whole corpus.
+    # Unit-length vectors make the inner product the cosine similarity, which
+    # the indexes search on. all-MiniLM-L6-v2 already ends with a Normalize
+    # layer, so this doesn't change its vectors or the cached ones.
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"batch_size": 256, "normalize_embeddings": True}
+    )
+
+embeddings = _load_embeddings()
+
+# The first encode loads the tokenizer and initializes the inference kernels,
+# a throwaway query at import keeps that off the first real search
+try:
+    embeddings.embed_query("warmup")
+except Exception as e:
+    print(f"Embedding model warm-up failed: {e}")
+
+# Vectors of already embedded texts, so rebuilding an index only embeds new content
+EMBEDDING_CACHE_PATH = "vector_db_index/embedding_cache.sqlite"
+
+# Stores smaller than this keep an exact flat index. IVF-PQ needs enough
+# vectors to train its coarse centroids and 256-entry PQ codebooks.
+IVFPQ_MIN_VECTORS = 10_000
+# The IVF-PQ search returns this many times k candidates, which are then
+# re-ranked on their SQ8 vectors
+REFINE_K_FACTOR = 4
+# Number of IVF cells visited per query. Also applied to IVF stores loaded
+# from disk: more cells give better recall, fewer faster searches.
+IVF_NPROBE = int(os.environ.get("FAISS_NPROBE", "16"))
+
+
+def _create_faiss_index(vectors: np.ndarray):
+    """
+    Creates an empty (trained) FAISS index suited to the number of vectors.
+    The returned index accepts explicit ids through add_with_ids. It ranks by
+    inner product, the cosine similarity of the normalized embeddings.
+
+    Large stores use OPQ48,IVF<sqrt(N)>,PQ48x4fs refined by SQ8: a query
+    scans about sqrt(N) centroids + nprobe * sqrt(N) 4-bit codes with the
+    SIMD fast-scan kernels, then re-ranks the best REFINE_K_FACTOR * k on
+    8-bit vectors, about 400 bytes per vector instead of 1.5KB.
+    """
+    n, d = vectors.shape
+    if n < IVFPQ_MIN_VECTORS:
+        # A flat index only numbers vectors sequentially, the IDMap2 keeps our ids
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+
+    nlist = int(math.sqrt(n))
+    # The refine stage numbers vectors sequentially too
+    index = faiss.index_factory(
+        d, f"IDMap2,OPQ48,IVF{nlist},PQ48x4fs,Refine(SQ8)", faiss.METRIC_INNER_PRODUCT
+    )
+    print(f"Training IVF-PQ index with {nlist} cells...")
+    index.train(vectors)
+    parameters = faiss.ParameterSpace()
+    parameters.set_index_parameter(index, "nprobe", IVF_NPROBE)
+    parameters.set_index_parameter(index, "k_factor_rf", REFINE_K_FACTOR)
+    return index
+
+
+def _distance_strategy(index) -> DistanceStrategy:
+    # Stores built before the switch to inner product still rank by L2 distance
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return DistanceStrategy.MAX_INNER_PRODUCT
+    return DistanceStrategy.EUCLIDEAN_DISTANCE
+
+
+def _load_vector_store(index_name: str, mmap: bool = True) -> FAISS:
+    """
+    Loads a saved store and applies the query-time search parameters.
+
+    The stored vectors are memory-mapped read-only by default, so they are
+    paged in from the file on demand and shared between processes through
+    the OS page cache. Stores that will be modified need mmap=False.
+    """
+    io_flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = faiss.read_index(os.path.join(index_name, "index.faiss"), io_flags)
+    with open(os.path.join(index_name, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    vector_store = FAISS(embeddings, index, docstore, index_to_docstore_id,
+                         distance_strategy=_distance_strategy(index))
+    if faiss.try_extract_index_ivf(vector_store.index) is not None:
+        faiss.ParameterSpace().set_index_parameter(vector_store.index, "nprobe", IVF_NPROBE)
+    return vector_store
+
+
+def _save_vector_store(vector_store: FAISS, index_name: str):
+    """
+    Same files as FAISS.save_local, but each is written to a temporary file
+    and renamed over the old one. A process that has the old index mapped
+    keeps reading the old file instead of seeing it rewritten.
+
+    The EMBEDDING_MODEL_ID of the vectors is saved next to them, last, so it
+    never names a model whose vectors aren't on disk yet.
+    """
+    os.makedirs(index_name, exist_ok=True)
+    index_path = os.path.join(index_name, "index.faiss")
+    faiss.write_index(vector_store.index, f"{index_path}.tmp")
+    os.replace(f"{index_path}.tmp", index_path)
+
+    pkl_path = os.path.join(index_name, "index.pkl")
+    with open(f"{pkl_path}.tmp", "wb") as f:
+        pickle.dump((vector_store.docstore, vector_store.index_to_docstore_id), f)
+    os.replace(f"{pkl_path}.tmp", pkl_path)
+
+    model_path = os.path.join(index_name, "embedding_model.txt")
+    with open(f"{model_path}.tmp", "w") as f:
+        f.write(EMBEDDING_MODEL_ID)
+    os.replace(f"{model_path}.tmp", model_path)
+
+
+def _saved_embedding_model_id(index_name: str) -> str | None:
+    """EMBEDDING_MODEL_ID a saved store was built with, None if not recorded."""
+    try:
+        with open(os.path.join(index_name, "embedding_model.txt")) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _embedding_cache_key(text: str) -> str:
+    return hashlib.blake2b(f"{EMBEDDING_MODEL_ID}\0{text}".encode(), digest_size=16).hexdigest()
+
+
+def _embed_documents_cached(texts: List[str]) -> np.ndarray:
+    """
+    Embeds the texts, reusing vectors stored in the on-disk cache by earlier builds.
+    Only distinct texts that are not in the cache are sent to the embedding model.
+    """
+    keys = [_embedding_cache_key(text) for text in texts]
+
+    os.makedirs(os.path.dirname(EMBEDDING_CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(EMBEDDING_CACHE_PATH)
+    try:
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (k TEXT PRIMARY KEY, v BLOB)")
+
+            vectors = {}
+            # Texts repeated across files (license headers, common comments)
+            # are looked up and embedded once, then shared
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key in vectors or key in missing:
+                    continue
+                row = conn.execute("SELECT v FROM cache WHERE k = ?", (key,)).fetchone()
+                if row:
+                    vectors[key] = np.frombuffer(row[0], dtype=np.float32)
+                else:
+                    missing[key] = text
+
+            print(f"Embedding {len(missing)} unique texts ({len(vectors)} cached, {len(texts)} documents)...")
+            if missing:
+                new_vectors = embeddings.embed_documents(list(missing.values()))
+                for key, vector in zip(missing, new_vectors):
+                    vectors[key] = np.asarray(vector, dtype=np.float32)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cache (k, v) VALUES (?, ?)",
+                    [(key, vectors[key].tobytes()) for key in missing]
+                )
+    finally:
+        conn.close()
+
+    return np.stack([vectors[key] for key in keys])
+
+
+def _document_id(doc: Document) -> int:
+    """
+    Stable 63-bit id of a document, derived from its content and metadata.
+    Used as the FAISS id so unchanged documents keep their id across builds.
+    """
+    payload = doc.page_content + "\0" + json.dumps(doc.metadata, sort_keys=True, default=str)
+    digest = hashlib.blake2b(payload.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & ((1 << 63) - 1)
+
+
+def _update_vector_store(vector_store: FAISS, docs_by_id: dict, model_id: str | None) -> int | None:
+    """
+    Brings an existing store in line with docs_by_id: vectors of documents that
+    are gone are removed and only new documents are embedded and added.
+    model_id is the EMBEDDING_MODEL_ID the store was saved with.
+    Returns the number of documents added and removed, or None if the store
+    has to be rebuilt from scratch instead.
+    """
+    # Vectors of another model (or backend, ONNX file, precision) can't be
+    # mixed with new ones, and stores that don't record it may be such vectors
+    if model_id != EMBEDDING_MODEL_ID:
+        return None
+    index_to_docstore_id = vector_store.index_to_docstore_id
+    # Stores built before content ids were introduced can't be diffed
+    if any(str(i) != doc_id for i, doc_id in index_to_docstore_id.items()):
+        return None
+    # L2 stores from before the switch to inner product are rebuilt once
+    if vector_store.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        return None
+
+    removed = [i for i in index_to_docstore_id if i not in docs_by_id]
+    added = [i for i in docs_by_id if i not in index_to_docstore_id]
+    # Past this point the IVF-PQ centroids no longer fit the corpus, or a flat
+    # store has grown big enough to be quantized, so retrain instead
+    if len(removed) + len(added) > len(docs_by_id) // 2:
+        return None
+    is_ivf = faiss.try_extract_index_ivf(vector_store.index) is not None
+    if not is_ivf and len(docs_by_id) >= IVFPQ_MIN_VECTORS:
+        return None
+    # Refined IVF-PQ indexes can't remove vectors, only add them
+    if is_ivf and removed:
+        return None
+    if not removed and not added:
+        return 0
+
+    print(f"Updating index: {len(added)} added, {len(removed)} removed...")
+    if removed:
+        vector_store.index.remove_ids(np.array(removed, dtype=np.int64))
+        vector_store.docstore.delete([str(i) for i in removed])
+        for i in removed:
+            del index_to_docstore_id[i]
+
+    if added:
+        vectors = _embed_documents_cached([docs_by_id[i].page_content for i in added])
+        vector_store.index.add_with_ids(vectors, np.array(added, dtype=np.int64))
+        vector_store.docstore.add({str(i): docs_by_id[i] for i in added})
+        index_to_docstore_id.update({i: str(i) for i in added})
+    return len(added) + len(removed)
+
+
+def _build_vector_store(docs: List[Document], index_name: str) -> FAISS:
+    """
+    Embeds all documents in one batched pass and saves the resulting index.
+    All vectors are added to FAISS in a single add_with_ids call and the
+    docstore is filled directly, keyed by the same ids.
+
+    If the index already exists on disk it is updated in place when possible,
+    so a rebuild only costs as much as the documents that changed.
+    """
+    # Identical documents share an id and are stored once
+    docs_by_id = {_document_id(doc): doc for doc in docs}
+
+    if os.path.exists(os.path.join(index_name, "index.faiss")):
+        vector_store = _load_vector_store(index_name, mmap=False)
+        changed = _update_vector_store(vector_store, docs_by_id, _saved_embedding_model_id(index_name))
+        if changed is not None:
+            # An unchanged store is left as it is on disk
+            if changed:
+                _save_vector_store(vector_store, index_name)
+            return vector_store
+
+    texts = [doc.page_content for doc in docs_by_id.values()]
+    vectors = _embed_documents_cached(texts)
+    ids = np.fromiter(docs_by_id, dtype=np.int64, count=len(docs_by_id))
+
+    index = _create_faiss_index(vectors)
+    index.add_with_ids(vectors, ids)
+
+    docstore = InMemoryDocstore({str(i): doc for i, doc in docs_by_id.items()})
+    index_to_docstore_id = {i: str(i) for i in docs_by_id}
+
+    vector_store = FAISS(embeddings, index, docstore, index_to_docstore_id,
+                         distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+    _save_vector_store(vector_store, index_name)
+    return vector_store
+
+def get_vector_store(captured_items: list | None = None, index_name: str  = None, load_from_disk: bool = False) -> FAISS:
 
     if load_from_disk:
         print("Loading index from disk...")
-        vector_store = FAISS.load_local(index_name, embeddings, allow_dangerous_deserialization=True)
-        return vector_store
-
-    docs = []
-    for item in captured_items:
-        content = item.get_content()
-        metadata = item.get_metadata()
-        doc = Document(page_content=content, metadata=metadata)
-        docs.append(doc)
-    
+        return _load_vector_store(index_name)
+
+    if not captured_items:
+        raise ValueError(f"No captured items to build {index_name} from")
+
+    docs = [Document(page_content=item.get_content(), metadata=item.get_metadata())
+            for item in captured_items]
+
     print("Building index...")
-    vector_store = FAISS.from_documents(docs, embeddings)
-    vector_store.save_local(index_name)
-    return vector_store
+    return _build_vector_store(docs, index_name)
+
+
+def _load_readme(file_path: str, splitter: RecursiveCharacterTextSplitter) -> List[Document]:
+    """
+    Reads one README file and splits it into Documents.
+    """
+    try:
+        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+            content = f.read()
+
+        # Skip empty files
+        if not content.strip():
+            return []
+
+        # The splitter returns a list of strings, each is wrapped in a
+        # Document with the file's metadata
+        return [
+            Document(
+                page_content=chunk,
+                metadata={
+                    "source": file_path,
+                    "file_name": os.path.basename(file_path),
+                    "type": "readme_documentation"
+                }
+            )
+            for chunk in splitter.split_text(content)
+        ]
+    except Exception as e:
+        print(f"Skipping {file_path}: {e}")
+        return []
 
 
 def get_vector_store_readme(
@@ -44,8 +385,7 @@ def get_vector_store_readme(
 
     if load_from_disk:
         print("Loading index from disk...")
-        vector_store = FAISS.load_local(index_name, embeddings, allow_dangerous_deserialization=True)
-        return vector_store
+        return _load_vector_store(index_name)
     
     # 1. Initialize the Splitter
     # We use 'from_language' to load standard Markdown separators:
@@ -56,97 +396,43 @@ def get_vector_store_readme(
         chunk_overlap=chunk_overlap
     )
 
-    documents = []
-
-    # 2. Walk the directory tree
-    for root, _, files in os.walk(repo_path):
-        for file in files:
-            # 3. Filter for README files
-            # Coreutils has files like: README, README-hacking, README.md
-            if "readme" in file.lower():
-                file_path = os.path.join(root, file)
-                
-                try:
-                    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                        content = f.read()
-                        
-                    # Skip empty files
-                    if not content.strip():
-                        continue
-
-                    # 4. Split the content
-                    # The splitter returns a list of strings
-                    chunks = splitter.split_text(content)
-                    
-                    # 5. Wrap in Document objects with Metadata
-                    for chunk in chunks:
-                        doc = Document(
-                            page_content=chunk,
-                            metadata={
-                                "source": file_path,
-                                "file_name": file,
-                                "type": "readme_documentation"
-                            }
-                        )
-                        documents.append(doc)
-                        
-                except Exception as e:
-                    print(f"Skipping {file_path}: {e}")
-
-    vector_store = FAISS.from_documents(documents, embeddings)
-    vector_store.save_local(index_name)
-    return vector_store
+    # 2. Find the README files
+    # Coreutils has files like: README, README-hacking, README.md
+    # The paths are joined onto repo_path as given, they are the documents'
+    # "source" and so part of their ids
+    file_paths = [os.path.join(root, file)
+                  for root, _, files in os.walk(repo_path)
+                  for file in files if "readme" in file.lower()]
 
-def get_top_readme_docs(vector_store: FAISS, query: str, k: int = 2, fetch_k: int = 10):
-    results = vector_store.similarity_search(
-        query,
-        k=k,
-        fetch_k=fetch_k,
-        filter={"type": "readme_documentation"}
-    )
-    return results
-
-def get_top_comments(vector_store: FAISS, query: str, k: int = 2, fetch_k: int = 10):
-    results = vector_store.similarity_search(
-        query,
-        k=k,
-        fetch_k=fetch_k,
-        filter={"document_type": "comment"}
-    )
-    return results
-
-def get_top_functions(vector_store: FAISS, query: str, k: int = 2, fetch_k: int = 10):
-    results = vector_store.similarity_search(
-        query,
-        k=k,
-        fetch_k=fetch_k,
-        filter={"document_type": ["function_definition"]}
-    )
-    return results
-
-def get_top_structs(vector_store: FAISS, query: str, k: int = 2, fetch_k: int = 10):
-    results = vector_store.similarity_search(
-        query,
-        k=k,
-        fetch_k=fetch_k,
-        filter={"document_type": "struct_definition"}
-    )
-    return results
-
-def get_top_enums(vector_store: FAISS, query: str, k: int = 2, fetch_k: int = 10):
-    results = vector_store.similarity_search(
-        query,
-        k=k,
-        fetch_k=fetch_k,
-        filter={"document_type": "enum_definition"}
-    )
-    return results
-
-def get_top_non_comments(vector_store: FAISS, query: str, k: int = 2, fetch_k: int = 10):
-    results = vector_store.similarity_search(
-        query,
-        k=k,
-        fetch_k=fetch_k,
-        # filter={"document_type": ["function_definition", "struct_definition", "enum_definition"]}
-    )
-    return results
+    # 3. Read and split them in parallel, so file reads overlap the splitting
+    with ThreadPoolExecutor() as pool:
+        per_file = pool.map(lambda file_path: _load_readme(file_path, splitter), file_paths)
+        documents = list(chain.from_iterable(per_file))
+
+    return _build_vector_store(documents, index_name)
+
+def get_top(
+    vector_store: FAISS,
+    query: str,
+    doc_types=None,
+    k: int = 2,
+    fetch_k: int = 10,
+    key: str = "document_type",
+) -> List[Document]:
+    """
+    Returns the top k documents of the given type(s), out of the fetch_k most
+    similar ones. doc_types is a single type, an iterable of types, or None
+    for every document.
+
+    The stores created by get_vector_store tag the type under "document_type"
+    and the README store under "type", e.g.
+    get_top(store, query, "readme_documentation", key="type").
+    """
+    if doc_types is None:
+        metadata_filter = None
+    elif isinstance(doc_types, str):
+        metadata_filter = {key: doc_types}
+    else:
+        metadata_filter = {key: {"$in": list(doc_types)}}
+
+    return vector_store.similarity_search(query, k=k, fetch_k=fetch_k, filter=metadata_filter)